@@ -1,9 +1,6 @@
-from .utils import *
+from .kegg_utils import *
 from .fasta_tools import *
 from .blast_gget import *
 from .blast_ncbi import *
-from .combined import *
-
-
-
-
+from .json_tools import *
+from .run_full import *
@@ -1,29 +1,86 @@
+import os
+import orjson
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 from gget import blast
-import json
+
+# NCBI asks that no more than a few searches run at once, so cap workers.
+MAX_BLAST_WORKERS = 3
 
 def collect_fasta_files(root="fasta_output"):
     """
     Recursively collect all .fasta files under a directory.
+
+    Walks via Path.rglob, which uses scandir and its cached DirEntry
+    stats underneath instead of os.walk's per-level list building.
     """
-    fasta_files = []
-    for root_dir, _, files in os.walk(root):
-        for file in files:
-            if file.endswith(".fasta") and not file.startswith("."):
-                fasta_files.append(os.path.join(root_dir, file))
-    return fasta_files
+    return [str(path) for path in Path(root).rglob("*.fasta")
+            if not path.name.startswith(".")]
 
 
 def read_fasta_sequence(file_path):
     """
-    Read raw DNA/protein sequence from FASTA file (skipping header).
+    Read raw DNA/protein sequence from FASTA file (skipping headers).
+
+    Uses Biopython's SimpleFastaParser (a plain-tuple generator, much
+    faster than SeqIO.parse). All records' sequences are concatenated
+    into one string — use read_fasta_records whenever per-record
+    identity matters.
+    """
+    with open(file_path, "r") as f:
+        return ''.join(seq for _, seq in SimpleFastaParser(f))
+
+def read_fasta_records(file_path):
+    """
+    Read all (header, sequence) records from a (multi-)FASTA file.
+
+    Headers are trimmed to their first token — the gene ID in files the
+    pipelines write — so callers can use them as query names directly.
     """
     with open(file_path, "r") as f:
-        lines = f.readlines()
-        return ''.join(line.strip() for line in lines if not line.startswith(">"))
+        return [(header.split()[0] if header else "", seq)
+                for header, seq in SimpleFastaParser(f)]
 
-def run_gget_blast_all(program="blastp", database="nr", limit=10, fasta_dir="fasta_output", output_dir="blast_results_gget"):
+def _blast_one(gene_name, sequence, program, database, limit, output_dir):
     """
-    Run gget BLAST search on all FASTA files inside `fasta_dir`.
+    BLAST a single sequence via gget and save the JSON result.
+
+    Returns the output path, or None if no hits came back.
+    Raises on BLAST/network failure so the caller can report it.
+    """
+    # gget BLAST
+    result = blast(
+        sequence,
+        program=program,
+        database=database,
+        limit=limit,
+        save=False,
+        json=True,
+        verbose=False
+    )
+
+    if not result or not isinstance(result, list):
+        print(f"⚠️ No BLAST hits returned for {gene_name}")
+        return None
+
+    # Save result
+    out_path = os.path.join(output_dir, f"{gene_name}_{program}_blast.json")
+    with open(out_path, "wb") as f:
+        f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2))
+    return out_path
+
+def run_gget_blast_all(program="blastp", database="nr", limit=10, fasta_dir="fasta_output", output_dir="blast_results_gget", max_workers=MAX_BLAST_WORKERS):
+    """
+    Run gget BLAST search on every FASTA record inside `fasta_dir`.
+
+    Each record in each (multi-)FASTA file goes up as its own query —
+    the per-species multi-FASTAs the pipelines write are never
+    concatenated into one chimeric sequence. Jobs are submitted through
+    a small thread pool so several network round-trips overlap (the
+    work is I/O-bound); `max_workers` stays low to respect NCBI usage
+    limits.
 
     Parameters:
         program (str): One of 'blastp', 'blastn', 'blastx', 'tblastn', 'tblastx'
@@ -31,6 +88,7 @@ def run_gget_blast_all(program="blastp", database="nr", limit=10, fasta_dir="fas
         limit (int): Max number of top hits per sequence
         fasta_dir (str): Root directory of .fasta files
         output_dir (str): Where to save resulting .json files
+        max_workers (int): Concurrent BLAST submissions (keep ≤3 for NCBI)
 
     Returns:
         None
@@ -38,43 +96,35 @@ def run_gget_blast_all(program="blastp", database="nr", limit=10, fasta_dir="fas
     os.makedirs(output_dir, exist_ok=True)
     fasta_files = collect_fasta_files(fasta_dir)
 
-    if not fasta_files:
+    records = []
+    for fasta_path in fasta_files:
+        file_records = read_fasta_records(fasta_path)
+        if not file_records:
+            print(f"⚠️ Empty sequence in: {fasta_path}")
+            continue
+        fallback_name = os.path.basename(fasta_path).replace(".fasta", "")
+        for header, sequence in file_records:
+            if sequence:
+                records.append((header or fallback_name, sequence))
+
+    if not records:
         print("❌ No FASTA files found to BLAST.")
         return
 
-    print(f"\n📁 Found {len(fasta_files)} FASTA file(s) to BLAST using gget.")
+    print(f"\n📁 Found {len(records)} sequence(s) in {len(fasta_files)} FASTA file(s) to BLAST using gget.")
 
-    for fasta_path in fasta_files:
-        gene_name = os.path.basename(fasta_path).replace(".fasta", "")
-        print(f"\n🔬 Running BLAST for: {gene_name}")
-
-        try:
-            sequence = read_fasta_sequence(fasta_path)
-            if not sequence:
-                print(f"⚠️ Empty sequence in: {fasta_path}")
-                continue
-
-            # gget BLAST
-            result = blast(
-                sequence,
-                program=program,
-                database=database,
-                limit=limit,
-                save=False,
-                json=True,
-                verbose=False
-            )
-
-            if not result or not isinstance(result, list):
-                print(f"⚠️ No BLAST hits returned for {gene_name}")
-                continue
-
-            # Save result
-            out_path = os.path.join(output_dir, f"{gene_name}_{program}_blast.json")
-            with open(out_path, "w") as f:
-                json.dump(result, f, indent=2)
-            print(f"✅ Saved to: {out_path}")
-
-        except Exception as e:
-            print(f"❌ Failed to BLAST {gene_name}: {e}")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for gene_name, sequence in records:
+            print(f"\n🔬 Submitting BLAST for: {gene_name}")
+            future = executor.submit(_blast_one, gene_name, sequence, program, database, limit, output_dir)
+            futures[future] = gene_name
 
+        for future in as_completed(futures):
+            gene_name = futures[future]
+            try:
+                out_path = future.result()
+                if out_path:
+                    print(f"✅ Saved to: {out_path}")
+            except Exception as e:
+                print(f"❌ Failed to BLAST {gene_name}: {e}")
@@ -1,6 +1,45 @@
+import hashlib
 import os
+import re
 import time
+import orjson
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
+from lxml import etree
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+from keggblast.blast_gget import MAX_BLAST_WORKERS, collect_fasta_files, read_fasta_records
+
+BLAST_URL = "https://blast.ncbi.nlm.nih.gov/Blast.cgi"
+
+# NCBI scores a whole multi-FASTA QUERY under one RID, so batching K
+# sequences per submission divides the submit/poll overhead by K.
+DEFAULT_BATCH_SIZE = 10
+
+# One shared session: keep-alive skips the TLS handshake on every
+# submit/poll/fetch round-trip, and flaky 5xx responses get retried.
+_SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=MAX_BLAST_WORKERS,
+    pool_maxsize=MAX_BLAST_WORKERS,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
+)
+_SESSION.mount("http://", _adapter)
+_SESSION.mount("https://", _adapter)
+
+# Gate on actual job submissions so polling threads never push us past the limit.
+_submit_semaphore = threading.Semaphore(MAX_BLAST_WORKERS)
+
+# Hit headers ('>title') and score lines as they alternate through NCBI
+# TEXT output — one compiled scan instead of a per-line Python loop.
+_HIT_EVENT_RE = re.compile(
+    r'^>\s*(?P<title>.+?)\s*$'
+    r'|Score\s*=\s*(?P<score>[^,\n]+?)\s*,(?:[^\n]*?Expect\s*=\s*(?P<evalue>[^,\s]+))?',
+    re.M
+)
 
 def parse_ncbi_blast_text(text):
     """
@@ -8,27 +47,290 @@ def parse_ncbi_blast_text(text):
     Returns list of dicts.
     """
     hits = []
-    current = {}
-
-    for line in text.splitlines():
-        if line.startswith(">"):
-            if current:
-                hits.append(current)
-            current = {"subject_title": line[1:].strip()}
-        elif "Score =" in line:
-            parts = line.split(",")
-            score = parts[0].split("=")[-1].strip()
-            evalue = parts[1].split("=")[-1].strip() if len(parts) > 1 else None
-            current["bit_score"] = score
-            current["evalue"] = evalue
-    if current:
-        hits.append(current)
+    current = None
+
+    for match in _HIT_EVENT_RE.finditer(text):
+        title = match.group('title')
+        if title is not None:
+            current = {"subject_title": title}
+            hits.append(current)
+        elif current is not None:
+            current["bit_score"] = match.group('score')
+            current["evalue"] = match.group('evalue')
 
     return hits
 
-def run_ncbi_blast_all(program="blastp", database="nr", tax_query=None, fasta_dir="fasta_output", output_dir="blast_results_ncbi"):
+def _parse_ncbi_blast_xml2(raw):
     """
-    Run NCBI BLAST with optional taxonomy filtering and save results as JSON.
+    Stream-parse NCBI XML2 output into the same hit dicts that
+    parse_ncbi_blast_text produces.
+
+    Hits are consumed incrementally via iterparse and each element is
+    cleared once read, so peak memory stays O(1) per hit instead of
+    O(result size).
+    """
+    hits = []
+    for _, elem in etree.iterparse(raw, events=('end',), tag='{*}Hit'):
+        hit = {
+            "subject_title": elem.findtext('.//{*}title'),
+            "bit_score": elem.findtext('.//{*}bit-score'),
+            "evalue": elem.findtext('.//{*}evalue'),
+        }
+        if hit["subject_title"]:
+            hit["subject_title"] = hit["subject_title"].strip()
+        hits.append(hit)
+        # Free the subtree (and any already-processed siblings).
+        elem.clear()
+        parent = elem.getparent()
+        if parent is not None:
+            while elem.getprevious() is not None:
+                del parent[0]
+    return hits
+
+def _submit_blast(query, program, database, tax_query):
+    """
+    Submit a query (single sequence or multi-FASTA text) via CMD=Put.
+
+    Returns (rid, rtoe). Raises on submission failure.
+    """
+    params = {
+        "CMD": "Put",
+        "PROGRAM": program,
+        "DATABASE": database,
+        "QUERY": query
+    }
+    if tax_query:
+        params["ENTREZ_QUERY"] = tax_query
+
+    with _submit_semaphore:
+        r = _SESSION.post(BLAST_URL, data=params)
+    if r.status_code != 200:
+        raise Exception("❌ Submission failed")
+
+    rid, rtoe = None, 15
+    for line in r.text.splitlines():
+        if "RID =" in line:
+            rid = line.split("=")[1].strip()
+        if "RTOE =" in line:
+            rtoe = int(line.split("=")[1].strip())
+    if not rid:
+        raise Exception("❌ RID not found in response.")
+
+    print(f"🧬 RID: {rid} | Estimated wait: {rtoe}s")
+    return rid, rtoe
+
+def _poll_blast(rid, label, rtoe=None):
+    """
+    Poll a RID until READY, with exponential backoff: check right away
+    so fast jobs return immediately, then back off toward NCBI's
+    recommended 60s ceiling for slow ones. Raises on FAILED/UNKNOWN.
+
+    NCBI's run-time estimate (RTOE) is historical, not a lower bound, so
+    it never delays the first check; if the job isn't ready yet, it
+    seeds the first wait (capped) before the backoff ladder takes over.
+    """
+    i = 0
+    while True:
+        status_check = _SESSION.get(BLAST_URL, params={
+            "CMD": "Get",
+            "FORMAT_OBJECT": "SearchInfo",
+            "RID": rid
+        })
+        if "Status=READY" in status_check.text:
+            print(f"✅ Search complete for {label}.")
+            return
+        elif "Status=FAILED" in status_check.text:
+            raise Exception("❌ BLAST job failed.")
+        elif "Status=UNKNOWN" in status_check.text:
+            raise Exception("❌ Unknown RID.")
+        else:
+            print(f"⏳ Waiting for result ({label})...")
+            if i == 0 and rtoe:
+                time.sleep(min(rtoe, 30))
+            else:
+                time.sleep(min(5 * (2 ** i), 60))
+            i += 1
+
+def _result_path(output_dir, name, program, sequence):
+    """
+    Result-JSON path for one query, keyed by a hash of its sequence.
+
+    The digest in the filename makes the output a content-addressed
+    cache entry: a re-run with the same sequence finds it and skips the
+    ~30s submit/poll cycle, while a changed sequence maps to a new file
+    instead of shadowing stale hits.
+    """
+    digest = hashlib.sha1(sequence.encode()).hexdigest()[:16]
+    return os.path.join(output_dir, f"{name}_{program}_{digest}_blast.json")
+
+def _evict_stale_results(result_path):
+    """
+    Delete sibling results for the same query saved under an older
+    sequence digest. The pipelines merge the whole result folder, so a
+    changed sequence must not leave its previous hits behind to leak
+    into the summary CSV.
+    """
+    directory, filename = os.path.split(result_path)
+    match = re.fullmatch(r'(.+)_[0-9a-f]{16}_blast\.json', filename)
+    if not match:
+        return
+    stale = re.compile(re.escape(match.group(1)) + r'_[0-9a-f]{16}_blast\.json')
+    with os.scandir(directory or ".") as entries:
+        for entry in entries:
+            if entry.name != filename and stale.fullmatch(entry.name):
+                os.remove(entry.path)
+                print(f"🧹 Removed stale result: {entry.name}")
+
+def _save_hits(result_path, hits):
+    """
+    Write hits JSON atomically (.part then rename) for safe resumption,
+    then clear any older-digest results for the same query.
+    """
+    part_path = result_path + ".part"
+    with open(part_path, "wb") as f:
+        f.write(orjson.dumps(hits, option=orjson.OPT_INDENT_2))
+    os.replace(part_path, result_path)
+    _evict_stale_results(result_path)
+
+def _blast_one(gene_name, sequence, program, database, tax_query, output_dir):
+    """
+    Submit one sequence to NCBI BLAST, poll until done, and save hits as JSON.
+
+    Skips the submission entirely if a result for the same sequence is
+    already on disk. Returns the result path. Raises on submission/
+    polling failure so the caller can report it.
+    """
+    result_path = _result_path(output_dir, gene_name, program, sequence)
+    if os.path.exists(result_path):
+        print(f"♻️ Reusing cached result for {gene_name}.")
+        return result_path
+
+    rid, rtoe = _submit_blast(sequence, program, database, tax_query)
+    _poll_blast(rid, gene_name, rtoe)
+
+    # Get results as structured XML2, streamed straight into the parser
+    # so the full report never sits in memory. Fall back to the TEXT
+    # format if NCBI returns something lxml cannot parse.
+    try:
+        result = _SESSION.get(BLAST_URL, params={
+            "CMD": "Get",
+            "RID": rid,
+            "FORMAT_TYPE": "XML2",
+            "FORMAT_OBJECT": "Alignment"
+        }, stream=True)
+        result.raw.decode_content = True
+        hits = _parse_ncbi_blast_xml2(result.raw)
+    except etree.XMLSyntaxError as e:
+        print(f"⚠️ XML2 parse failed ({e}); retrying with TEXT format.")
+        result = _SESSION.get(BLAST_URL, params={
+            "CMD": "Get",
+            "RID": rid,
+            "FORMAT_TYPE": "Text",
+            "FORMAT_OBJECT": "Alignment"
+        })
+        hits = parse_ncbi_blast_text(result.text)
+
+    # Save JSON
+    _save_hits(result_path, hits)
+    return result_path
+
+def _parse_ncbi_blast_xml2_by_query(raw):
+    """
+    Stream-parse multi-query XML2 output, yielding (query_title, hits)
+    per Search element. Same memory behaviour as _parse_ncbi_blast_xml2.
+    """
+    for _, elem in etree.iterparse(raw, events=('end',), tag='{*}Search'):
+        query = elem.findtext('{*}query-title') or elem.findtext('{*}query-id')
+        hits = []
+        for hit_elem in elem.iterfind('.//{*}Hit'):
+            hit = {
+                "subject_title": hit_elem.findtext('.//{*}title'),
+                "bit_score": hit_elem.findtext('.//{*}bit-score'),
+                "evalue": hit_elem.findtext('.//{*}evalue'),
+            }
+            if hit["subject_title"]:
+                hit["subject_title"] = hit["subject_title"].strip()
+            hits.append(hit)
+        yield query, hits
+        elem.clear()
+        parent = elem.getparent()
+        if parent is not None:
+            while elem.getprevious() is not None:
+                del parent[0]
+
+def _blast_batch(records, program, database, tax_query, output_dir):
+    """
+    BLAST several (gene_name, sequence) records under one RID.
+
+    The records go up as a single multi-FASTA QUERY, wait through one
+    submit/poll cycle, and come back per query in the XML2 report; each
+    query's hits are saved to its own JSON, named as in _blast_one.
+    Records whose result JSON already exists are reused rather than
+    resubmitted, and repeated headers within a batch get a numeric
+    suffix so no query can shadow another's entry or output file. If the
+    XML2 report cannot be parsed, every pending record is resubmitted
+    individually through _blast_one (which has its own TEXT fallback).
+    Returns the list of result paths.
+    """
+    pending, result_paths = [], []
+    path_by_query = {}
+    name_counts = {}
+    for name, seq in records:
+        # Disambiguate duplicate headers: 'x', 'x.2', 'x.3', ...
+        count = name_counts.get(name, 0) + 1
+        name_counts[name] = count
+        query_name = name if count == 1 else f"{name}.{count}"
+
+        path = _result_path(output_dir, query_name, program, seq)
+        if os.path.exists(path):
+            print(f"♻️ Reusing cached result for {query_name}.")
+            result_paths.append(path)
+        else:
+            pending.append((query_name, seq))
+            path_by_query[query_name] = path
+
+    if not pending:
+        return result_paths
+
+    multi_fasta = "\n".join(f">{name}\n{seq}" for name, seq in pending)
+    label = f"batch of {len(pending)}"
+
+    rid, rtoe = _submit_blast(multi_fasta, program, database, tax_query)
+    _poll_blast(rid, label, rtoe)
+
+    try:
+        result = _SESSION.get(BLAST_URL, params={
+            "CMD": "Get",
+            "RID": rid,
+            "FORMAT_TYPE": "XML2",
+            "FORMAT_OBJECT": "Alignment"
+        }, stream=True)
+        result.raw.decode_content = True
+
+        for query, hits in _parse_ncbi_blast_xml2_by_query(result.raw):
+            result_path = path_by_query.get(
+                query, os.path.join(output_dir, f"{query}_{program}_blast.json"))
+            _save_hits(result_path, hits)
+            result_paths.append(result_path)
+    except etree.XMLSyntaxError as e:
+        # Same safety net as the single-query path: don't throw away a
+        # whole batch after the submit/poll wait. Records whose hits
+        # already landed before the parse broke are cache hits here.
+        print(f"⚠️ XML2 parse failed for {label} ({e}); resubmitting records individually.")
+        for query_name, seq in pending:
+            result_path = _blast_one(query_name, seq, program, database, tax_query, output_dir)
+            if result_path not in result_paths:
+                result_paths.append(result_path)
+    return result_paths
+
+def run_ncbi_blast_multi(program="blastp", database="nr", tax_query=None, fasta_dir="fasta_output", output_dir="blast_results_ncbi", batch_size=DEFAULT_BATCH_SIZE, max_workers=MAX_BLAST_WORKERS):
+    """
+    Run NCBI BLAST over all FASTA files, batching sequences per RID.
+
+    Batches of `batch_size` sequences go up as one multi-FASTA QUERY, so
+    K sequences share a single submit/poll cycle — the per-RID wait is
+    what dominates pipeline wall time. Batches still run through the
+    worker pool, and each gene keeps its own output JSON.
 
     Args:
         program (str): blastp, blastn, blastx, tblastn, tblastx
@@ -36,6 +338,8 @@ def run_ncbi_blast_all(program="blastp", database="nr", tax_query=None, fasta_di
         tax_query (str): e.g. 'txid9606[ORGN]'
         fasta_dir (str): Folder with input FASTA files
         output_dir (str): Folder to save results
+        batch_size (int): Sequences to coalesce per BLAST submission
+        max_workers (int): Concurrent BLAST jobs (keep ≤3 for NCBI)
 
     Returns:
         None
@@ -43,74 +347,62 @@ def run_ncbi_blast_all(program="blastp", database="nr", tax_query=None, fasta_di
     os.makedirs(output_dir, exist_ok=True)
     fasta_files = collect_fasta_files(fasta_dir)
 
-    print(f"\n📂 Found {len(fasta_files)} FASTA file(s) for NCBI BLAST.")
-
+    records = []
     for fasta in fasta_files:
-        gene_name = os.path.basename(fasta).replace(".fasta", "")
-        print(f"\n🚀 Submitting {gene_name} to NCBI BLAST...")
+        file_records = read_fasta_records(fasta)
+        if not file_records:
+            print(f"⚠️ Empty sequence in: {fasta}")
+            continue
+        fallback_name = os.path.basename(fasta).replace(".fasta", "")
+        for header, sequence in file_records:
+            if sequence:
+                records.append((header or fallback_name, sequence))
 
-        try:
-            sequence = read_fasta_sequence(fasta)
+    if not records:
+        print("❌ No FASTA files found to BLAST.")
+        return
 
-            params = {
-                "CMD": "Put",
-                "PROGRAM": program,
-                "DATABASE": database,
-                "QUERY": sequence
-            }
-            if tax_query:
-                params["ENTREZ_QUERY"] = tax_query
-
-            r = requests.post("https://blast.ncbi.nlm.nih.gov/Blast.cgi", data=params)
-            if r.status_code != 200:
-                raise Exception("❌ Submission failed")
-
-            rid, rtoe = None, 15
-            for line in r.text.splitlines():
-                if "RID =" in line:
-                    rid = line.split("=")[1].strip()
-                if "RTOE =" in line:
-                    rtoe = int(line.split("=")[1].strip())
-            if not rid:
-                raise Exception("❌ RID not found in response.")
-
-            print(f"🧬 RID: {rid} | Estimated wait: {rtoe}s")
-            time.sleep(rtoe + 5)
-
-            # Poll for completion
-            while True:
-                status_check = requests.get("https://blast.ncbi.nlm.nih.gov/Blast.cgi", params={
-                    "CMD": "Get",
-                    "FORMAT_OBJECT": "SearchInfo",
-                    "RID": rid
-                })
-                if "Status=READY" in status_check.text:
-                    print("✅ Search complete.")
-                    break
-                elif "Status=FAILED" in status_check.text:
-                    raise Exception("❌ BLAST job failed.")
-                elif "Status=UNKNOWN" in status_check.text:
-                    raise Exception("❌ Unknown RID.")
-                else:
-                    print("⏳ Waiting for result...")
-                    time.sleep(30)
-
-            # Get results (TEXT format for easier parsing)
-            result = requests.get("https://blast.ncbi.nlm.nih.gov/Blast.cgi", params={
-                "CMD": "Get",
-                "RID": rid,
-                "FORMAT_TYPE": "Text",
-                "FORMAT_OBJECT": "Alignment"
-            })
-
-            hits = parse_ncbi_blast_text(result.text)
-
-            # Save JSON
-            result_path = os.path.join(output_dir, f"{gene_name}_{program}_blast.json")
-            with open(result_path, "w") as f:
-                json.dump(hits, f, indent=2)
-            print(f"💾 Saved: {result_path}")
-
-        except Exception as e:
-            print(f"❌ Failed BLAST for {gene_name}: {e}")
+    batches = [records[i:i + batch_size] for i in range(0, len(records), batch_size)]
+    print(f"\n📂 Submitting {len(records)} sequence(s) to NCBI BLAST in {len(batches)} batch(es).")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(_blast_batch, batch, program, database, tax_query, output_dir): idx
+            for idx, batch in enumerate(batches, 1)
+        }
+        for future in as_completed(futures):
+            idx = futures[future]
+            try:
+                for result_path in future.result():
+                    print(f"💾 Saved: {result_path}")
+            except Exception as e:
+                print(f"❌ Failed BLAST for batch {idx}: {e}")
+
+def run_ncbi_blast_all(program="blastp", database="nr", tax_query=None, fasta_dir="fasta_output", output_dir="blast_results_ncbi", max_workers=MAX_BLAST_WORKERS):
+    """
+    Run NCBI BLAST with optional taxonomy filtering and save results as JSON.
+
+    Kept as the documented entry point; delegates to run_ncbi_blast_multi,
+    which submits every FASTA record as its own query — a per-species
+    multi-FASTA written by the pipelines is never concatenated into one
+    chimeric sequence.
+
+    Args:
+        program (str): blastp, blastn, blastx, tblastn, tblastx
+        database (str): nr, nt, refseq_rna, etc.
+        tax_query (str): e.g. 'txid9606[ORGN]'
+        fasta_dir (str): Folder with input FASTA files
+        output_dir (str): Folder to save results
+        max_workers (int): Concurrent BLAST jobs (keep ≤3 for NCBI)
 
+    Returns:
+        None
+    """
+    run_ncbi_blast_multi(
+        program=program,
+        database=database,
+        tax_query=tax_query,
+        fasta_dir=fasta_dir,
+        output_dir=output_dir,
+        max_workers=max_workers
+    )
@@ -1,5 +1,39 @@
-import os
-import requests
+import re
+
+# Sequence blocks in a KEGG gene entry: the section header with a
+# length, then consecutive 12-space-indented sequence lines. Compiled
+# once so extract_sequence is a single C-level search per call.
+_SEQ_PATTERNS = {
+    "AASEQ": re.compile(r'^AASEQ\s+\d+\n((?: {12}.*\n?)+)', re.M),
+    "NTSEQ": re.compile(r'^NTSEQ\s+\d+\n((?: {12}.*\n?)+)', re.M),
+}
+
+# Memoized (gene_df, index) for the most recent gene table
+# (see _species_gene_index).
+_species_index_cache = None
+
+def _species_gene_index(gene_df):
+    """
+    Build (once per DataFrame) a lowercase 'Species ID' → 'Genes' dict.
+
+    Filtering with gene_df['Species ID'].str.lower() re-lowercases the
+    whole column on every call; this memoizes a plain dict so repeated
+    lookups are O(1). Only the most recent table's index is kept —
+    pipelines work through one KO's table at a time, and a single slot
+    can't pin every DataFrame a long-lived process ever indexed.
+    """
+    global _species_index_cache
+
+    cached = _species_index_cache
+    if cached is not None and cached[0] is gene_df:
+        return cached[1]
+
+    index = {}
+    for sid, genes in zip(gene_df['Species ID'].str.lower(), gene_df['Genes']):
+        index.setdefault(sid, genes)
+
+    _species_index_cache = (gene_df, index)
+    return index
 
 def extract_genes_for_species(gene_df, species_id, verbose=False):
     """
@@ -19,20 +53,20 @@ def extract_genes_for_species(gene_df, species_id, verbose=False):
     if "Species ID" not in gene_df.columns or "Genes" not in gene_df.columns:
         raise KeyError("❌ gene_df must have columns: 'Species ID' and 'Genes'.")
 
-    subset = gene_df[gene_df['Species ID'].str.lower() == species_id.lower()]
+    genes_raw = _species_gene_index(gene_df).get(species_id.lower())
 
-    if subset.empty:
+    if genes_raw is None:
         if verbose:
             print(f"⚠️ No gene entry found for species ID: {species_id}")
         return []
 
-    genes_raw = subset.iloc[0]["Genes"]
     if not isinstance(genes_raw, str):
         return []
 
     # Split by whitespace (not comma!)
-    gene_list = [g.strip().split()[-1] for g in genes_raw.strip().split()]
-    
+    gene_list = genes_raw.split()
+
+
     if verbose:
         print(f"🧬 Extracted {len(gene_list)} gene(s) for {species_id}:")
         print(gene_list)
@@ -50,26 +84,18 @@ def extract_sequence(entry_text, key="AASEQ"):
     Returns:
         str or None: The extracted sequence in uppercase, or None if not found.
     """
-    if key not in ["AASEQ", "NTSEQ"]:
+    if key not in _SEQ_PATTERNS:
         raise ValueError("❌ Key must be 'AASEQ' or 'NTSEQ'")
 
-    lines = entry_text.splitlines()
-    seq_lines = []
-    capture = False
-
-    for line in lines:
-        if line.startswith(key):
-            capture = True
-            continue
-        if capture:
-            if not line.startswith(" " * 12):  # block ends if indent is gone
-                break
-            seq_lines.append(line.strip())
+    match = _SEQ_PATTERNS[key].search(entry_text)
+    if not match:
+        return None
 
-    if seq_lines:
-        sequence = ''.join(seq_lines).upper()
-        return sequence
-    return None
+    # KEGG sequences are plain ASCII, so collapse whitespace and upcase
+    # on a contiguous bytes buffer: one C pass each, no intermediate
+    # str copy between the join and the upper().
+    block = match.group(1).encode('ascii')
+    return b''.join(block.split()).upper().decode('ascii')
 
 def write_fasta_file(path, header, sequence):
     """
@@ -95,10 +121,58 @@ def write_fasta_file(path, header, sequence):
         path += ".fasta"
 
     try:
+        # Build the wrapped body once and write it in a single call
+        # instead of one write per 70-char slice.
+        body = "\n".join(sequence[i:i+70] for i in range(0, len(sequence), 70))
         with open(path, 'w') as f:
-            f.write(f">{header}\n")
-            for i in range(0, len(sequence), 70):
-                f.write(sequence[i:i+70] + "\n")
+            f.write(f">{header}\n{body}\n")
         print(f"✅ FASTA saved: {path}")
     except Exception as e:
         raise OSError(f"❌ Could not write FASTA file: {e}")
+
+def write_multi_fasta_file(path, records):
+    """
+    Write many (header, sequence) records into one multi-FASTA file.
+
+    One aggregated file per species replaces a file per gene — far
+    fewer opens, inode lookups and directory entries when hundreds of
+    genes are written and read back. The whole payload is assembled in
+    memory and written in a single call.
+
+    Args:
+        path (str): Full path to output .fasta file.
+        records (iterable): (header, sequence) tuples; same validation
+            as write_fasta_file applies to each.
+
+    Raises:
+        ValueError: If records is empty or any record is invalid.
+        OSError: If file cannot be written.
+    """
+    records = list(records)
+    if not records:
+        raise ValueError("❌ No FASTA records to write.")
+
+    # Ensure file extension
+    if not path.lower().endswith(".fasta"):
+        path += ".fasta"
+
+    chunks = []
+    for header, sequence in records:
+        if not header or not isinstance(header, str):
+            raise ValueError("❌ FASTA header must be a non-empty string.")
+        if not sequence or not isinstance(sequence, str):
+            raise ValueError("❌ Sequence must be a non-empty string.")
+        body = "\n".join(sequence[i:i+70] for i in range(0, len(sequence), 70))
+        chunks.append(f">{header}\n{body}\n")
+
+    # Encode the whole payload up front and write it in binary mode:
+    # one big os.write the kernel can flush in page-aligned chunks, with
+    # no TextIOWrapper encode pass during the write itself.
+    payload = "".join(chunks).encode("utf-8")
+
+    try:
+        with open(path, 'wb') as f:
+            f.write(payload)
+        print(f"✅ FASTA saved: {path} ({len(records)} record(s))")
+    except Exception as e:
+        raise OSError(f"❌ Could not write FASTA file: {e}")
@@ -1,3 +1,24 @@
+import csv
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+
+import orjson
+import pandas as pd
+
+@lru_cache(maxsize=256)
+def _load_blast_json(path, mtime):
+    """
+    Parse one BLAST JSON file, memoized on (path, mtime).
+
+    Re-reading the same result file (common in interactive analysis) is
+    a cache hit; editing the file changes its mtime and busts the entry.
+    Callers must treat the returned object as read-only — it is shared.
+    """
+    # orjson parses straight from bytes at C speed (2-5x stdlib json)
+    with open(path, 'rb') as f:
+        return orjson.loads(f.read())
+
 def blast_json_to_table(json_file):
     '''
     Convert BLAST JSON output (from gget or NCBI if json formatted) to a pandas DataFrame.
@@ -8,19 +29,18 @@ def blast_json_to_table(json_file):
     Returns:
         pd.DataFrame: Table with all BLAST hits and metadata
     '''
-    with open(json_file, 'r') as f:
-        data = json.load(f)
+    data = _load_blast_json(json_file, os.path.getmtime(json_file))
 
     # In gget, the data is a list of hits
     if isinstance(data, list):
         df = pd.json_normalize(data)
         return df
-    
+
     # NCBI might wrap results differently (not typical JSON output though)
     elif isinstance(data, dict) and 'BlastOutput2' in data:
         # advanced parsing would go here
         raise NotImplementedError("NCBI JSON parser not implemented yet.")
-    
+
     else:
         raise ValueError("❌ Unknown BLAST JSON structure")
 
@@ -28,27 +48,106 @@ def blast_json_to_table(json_file):
 #df = blast_json_to_table("blast_results_gget/gene1_blastn_blast.json")
 #df
 
+def _load_records(path):
+    """Parse one result file into raw hit dicts tagged with their source."""
+    with open(path, 'rb') as f:
+        data = orjson.loads(f.read())
+
+    if not isinstance(data, list):
+        raise ValueError("❌ Unknown BLAST JSON structure")
+
+    file = os.path.basename(path)
+    for record in data:
+        record["__source_file__"] = file
+    return data
+
+def _load_all_records(folder_path):
+    """Concurrently parse every result JSON in a folder into one hit list."""
+    # os.scandir yields name, path and file type from one readdir pass,
+    # so no per-entry stat calls and no separate join step.
+    with os.scandir(folder_path) as entries:
+        paths = [entry.path for entry in entries
+                 if entry.is_file() and entry.name.endswith(".json")]
+
+    records = []
+    with ThreadPoolExecutor() as executor:
+        futures = {executor.submit(_load_records, path): path for path in paths}
+        for future in as_completed(futures):
+            file = os.path.basename(futures[future])
+            try:
+                records.extend(future.result())
+            except Exception as e:
+                print(f"⚠️ Skipped {file}: {e}")
+
+    return records
+
 def parse_json_blast_to_table(folder_path):
     '''
     Batch-parse all BLAST result JSON files in a folder into one DataFrame.
 
+    Files are read through a thread pool so disk/parse work overlaps.
+    The raw hit dicts are pooled and flattened with one pd.json_normalize
+    call, so schema inference and frame allocation happen once instead
+    of per file.
+
     Parameters:
         folder_path (str): Directory containing JSON result files
 
     Returns:
         pd.DataFrame: Combined results
     '''
-    import os
-    all_rows = []
-    
-    for file in os.listdir(folder_path):
-        if file.endswith(".json"):
-            path = os.path.join(folder_path, file)
-            try:
-                df = blast_json_to_table(path)
-                df["__source_file__"] = file
-                all_rows.append(df)
-            except Exception as e:
-                print(f"⚠️ Skipped {file}: {e}")
-    
-    return pd.concat(all_rows, ignore_index=True) if all_rows else pd.DataFrame()
+    records = _load_all_records(folder_path)
+    if not records:
+        return pd.DataFrame()
+
+    # Hit dicts from both backends are flat, so assemble the frame
+    # column-wise (dict of lists) — pandas builds that far faster than
+    # it flattens a list of dicts. Anything nested still goes through
+    # json_normalize.
+    if any(isinstance(value, dict) for record in records for value in record.values()):
+        return pd.json_normalize(records)
+
+    keys = dict.fromkeys(key for record in records for key in record)
+    return pd.DataFrame({key: [record.get(key) for record in records]
+                         for key in keys})
+
+def blast_results_to_csv(folder_path, output_csv):
+    '''
+    Parse every BLAST JSON in a folder and write one merged CSV.
+
+    The JSONs are decoded concurrently (see _load_all_records) and the
+    combined table lands in a single CSV — one output file and one write
+    pass rather than a CSV per result JSON.
+
+    The rows go straight from the parsed hit dicts through one
+    csv.writer on a single open file — no intermediate DataFrame and no
+    pandas to_csv formatter on the write side. Use
+    parse_json_blast_to_table if you want the table in memory.
+
+    Parameters:
+        folder_path (str): Directory containing JSON result files
+        output_csv (str): Path of the merged CSV to write
+    '''
+    records = _load_all_records(folder_path)
+    if not records:
+        print("⚠️ No BLAST results found to merge.")
+        return
+
+    # Union of keys in first-seen order, so the header is stable and
+    # files with extra fields still land in the right columns.
+    columns = []
+    seen = set()
+    for record in records:
+        for key in record:
+            if key not in seen:
+                seen.add(key)
+                columns.append(key)
+
+    with open(output_csv, 'w', newline='', buffering=1 << 20) as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        writer.writerows(
+            [record.get(col, "") for col in columns] for record in records
+        )
+
+    print(f"✅ Merged BLAST table saved: {output_csv}")
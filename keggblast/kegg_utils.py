@@ -1,10 +1,50 @@
-import requests
-import pandas as pd
-from collections import defaultdict
+import functools
 import os
-from datetime import datetime, timedelta
-from rapidfuzz import process
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
+import numpy as np
+import pandas as pd
+import requests
+import requests_cache
+from rapidfuzz import process, fuzz
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+from keggblast.fasta_tools import _species_gene_index
+
+# Where the on-disk KEGG response cache lives, and how long entries stay
+# fresh. KEGG entries are static on day timescales, so warm reruns of a
+# pipeline answer from sqlite instead of the network.
+KEGG_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "keggblast")
+KEGG_CACHE_TTL = 86400  # seconds
+
+os.makedirs(KEGG_CACHE_DIR, exist_ok=True)
+
+# Shared session for all KEGG REST calls: keep-alive avoids a fresh
+# TCP+TLS handshake per gene fetch, transient 5xx errors get retried,
+# and responses are cached on disk keyed by the full request URL.
+_SESSION = requests_cache.CachedSession(
+    os.path.join(KEGG_CACHE_DIR, "kegg_cache"),
+    expire_after=KEGG_CACHE_TTL,
+    allowable_codes=[200]   # never cache error responses
+)
+_adapter = HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=10,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
+)
+_SESSION.mount("http://", _adapter)
+_SESSION.mount("https://", _adapter)
+
+# GENES block of a KO entry: starts at the 'GENES' header, runs until
+# the next non-indented section header (or end of entry).
+_GENES_BLOCK_RE = re.compile(r'^GENES\s+(.*?)(?=^\S|\Z)', re.S | re.M)
+# One 'SPECIES: gene1 gene2 ...' line inside the block.
+_GENES_LINE_RE = re.compile(r'^\s*([A-Za-z0-9]+):\s*(.*?)\s*$', re.M)
+
+@functools.lru_cache(maxsize=4096)
 def fetch_kegg_orthology(ko_id):
     '''
     Download a KEGG Orthology entry using the KO ID.
@@ -22,10 +62,10 @@ def fetch_kegg_orthology(ko_id):
     if not ko_id or not ko_id.startswith("K"):
         raise ValueError("❌ KO ID must start with 'K' (e.g. 'K09252')")
 
-    url = f"http://rest.kegg.jp/get/{ko_id}"
+    url = f"https://rest.kegg.jp/get/{ko_id}"
 
     try:
-        response = requests.get(url, timeout=10)
+        response = _SESSION.get(url, timeout=10)
     except requests.RequestException as e:
         raise requests.RequestException(f"❌ Network error while fetching KO: {e}")
 
@@ -45,6 +85,7 @@ def fetch_kegg_orthology(ko_id):
 
     return content
 
+@functools.lru_cache(maxsize=4096)
 def fetch_gene_entry(kegg_gene_id):
     '''
     Fetch a full KEGG gene entry using species:gene format.
@@ -62,10 +103,10 @@ def fetch_gene_entry(kegg_gene_id):
     if not kegg_gene_id or ":" not in kegg_gene_id:
         raise ValueError("❌ KEGG gene ID must be in format 'species_id:gene' (e.g., 'hsa:BRCA1')")
 
-    url = f"http://rest.kegg.jp/get/{kegg_gene_id}"
+    url = f"https://rest.kegg.jp/get/{kegg_gene_id}"
 
     try:
-        response = requests.get(url, timeout=10)
+        response = _SESSION.get(url, timeout=10)
     except requests.RequestException as e:
         raise requests.RequestException(f"❌ Network error while fetching gene: {e}")
 
@@ -82,6 +123,72 @@ def fetch_gene_entry(kegg_gene_id):
 
     return content
 
+# KEGG's REST get endpoint accepts up to 10 '+'-joined IDs per call.
+KEGG_BATCH_SIZE = 10
+
+def fetch_gene_entries_batch(kegg_gene_ids):
+    '''
+    Fetch up to 10 KEGG gene entries with a single REST call.
+
+    KEGG returns the entries concatenated, each terminated by '///', in
+    request order. If an ID is silently dropped (the counts no longer
+    line up) or the batch call fails, the chunk falls back to per-ID
+    fetches so no entry is mis-assigned.
+
+    Parameters:
+        kegg_gene_ids (list): Up to KEGG_BATCH_SIZE IDs like 'hsa:BRCA1'
+
+    Returns:
+        dict: kegg_gene_id → entry text (successful fetches only)
+    '''
+    if len(kegg_gene_ids) > KEGG_BATCH_SIZE:
+        raise ValueError(f"❌ KEGG accepts at most {KEGG_BATCH_SIZE} IDs per get call.")
+
+    url = "https://rest.kegg.jp/get/" + "+".join(kegg_gene_ids)
+
+    try:
+        response = _SESSION.get(url, timeout=30)
+        response.raise_for_status()
+        entry_texts = [text.strip() for text in response.text.split("///") if text.strip()]
+        if len(entry_texts) == len(kegg_gene_ids):
+            return dict(zip(kegg_gene_ids, entry_texts))
+        print(f"⚠️ KEGG returned {len(entry_texts)}/{len(kegg_gene_ids)} entries; resolving individually.")
+    except requests.RequestException as e:
+        print(f"⚠️ Batch fetch failed ({e}); resolving individually.")
+
+    entries = {}
+    for gene_id in kegg_gene_ids:
+        try:
+            entries[gene_id] = fetch_gene_entry(gene_id)
+        except Exception as e:
+            print(f"⚠️ Skipped {gene_id}: {e}")
+    return entries
+
+def fetch_gene_entries(kegg_gene_ids, max_workers=10):
+    '''
+    Fetch many KEGG gene entries concurrently, 10 per request.
+
+    IDs are chunked to KEGG's multi-ID get limit so every round-trip
+    carries up to 10 entries, and the chunks themselves run through a
+    small thread pool over the shared pooled session. Failed fetches
+    are reported and skipped rather than aborting the batch.
+
+    Parameters:
+        kegg_gene_ids (list): KEGG gene IDs like 'hsa:BRCA1'
+        max_workers (int): Number of concurrent chunk fetches
+
+    Returns:
+        dict: kegg_gene_id → entry text (successful fetches only)
+    '''
+    chunks = [kegg_gene_ids[i:i + KEGG_BATCH_SIZE]
+              for i in range(0, len(kegg_gene_ids), KEGG_BATCH_SIZE)]
+
+    entries = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for chunk_entries in executor.map(fetch_gene_entries_batch, chunks):
+            entries.update(chunk_entries)
+    return entries
+
 def parse_gene_table(entry_text):
     '''
     Extracts the "GENES" section from a KEGG KO entry and returns
@@ -93,34 +200,28 @@ def parse_gene_table(entry_text):
     Returns:
         DataFrame: species_id → genes (str) → count
     '''
-    in_genes = False
-    data = defaultdict(list)
-
-    for line in entry_text.splitlines():
-        if line.startswith("GENES"):
-            in_genes = True
-            line = line[12:]
-        elif in_genes and line.startswith(" " * 12):
-            line = line[12:]
-        elif in_genes:
-            break  # exited the GENES block
-        else:
-            continue  # skip until GENES section starts
-
-        if ":" in line:
-            try:
-                species_id, genes = line.strip().split(":", 1)
-                gene_list = genes.strip().split()
-                data["Species ID"].append(species_id.strip())
-                data["Genes"].append(" ".join(gene_list))
-                data["Number of Genes"].append(len(gene_list))
-            except Exception as e:
-                print(f"⚠️ Skipped malformed line: {line} -> {e}")
+    # Slice out the GENES block with one regex (the block ends at the
+    # next non-indented section header), then pull all species:genes
+    # pairs in a single C-level findall instead of a per-line state loop.
+    block_match = _GENES_BLOCK_RE.search(entry_text)
+    if not block_match:
+        raise ValueError("❌ No 'GENES' section found or it was empty in KO entry.")
 
-    if not data:
+    matches = _GENES_LINE_RE.findall(block_match.group(1))
+    if not matches:
         raise ValueError("❌ No 'GENES' section found or it was empty in KO entry.")
 
-    return pd.DataFrame(data)
+    # Exact-size allocations: zip(*) splits the match pairs in one go,
+    # and the counts land in an int64 array instead of boxed Python ints.
+    species_ids, gene_strs = zip(*matches)
+    gene_lists = [genes.split() for genes in gene_strs]
+
+    return pd.DataFrame({
+        "Species ID": list(species_ids),
+        "Genes": [" ".join(gene_list) for gene_list in gene_lists],
+        "Number of Genes": np.fromiter(map(len, gene_lists), dtype=np.int64,
+                                       count=len(gene_lists))
+    })
 
 def save_gene_table_as_csv(df, filename="kegg_gene_table.csv"):
     '''
@@ -155,6 +256,32 @@ SPECIES_CSV = "species_cache.csv"
 META_FILE = "species_cache_meta.txt"
 UPDATE_INTERVAL_DAYS = 7
 
+# Known schema for the species cache — skips pandas type inference.
+_SPECIES_DTYPES = {
+    'Taxonomy ID': 'string',
+    'Species ID': 'string',
+    'Species Name': 'string',
+    'Common Name': 'string',
+}
+
+def _species_parquet_path(species_csv):
+    """Parquet twin of the species CSV cache (same basename)."""
+    return os.path.splitext(species_csv)[0] + ".parquet"
+
+def _with_lowercase_columns(df):
+    """
+    Attach precomputed lowercase helper columns to the species frame.
+
+    Every matcher needs case-folded IDs and names; lowering each column
+    once here (vectorized) replaces the per-call / per-row .lower()
+    scans. Added after the cache files are written so they never leak
+    into the CSV/parquet on disk.
+    """
+    df['_sid_lc'] = df['Species ID'].str.lower()
+    df['_name_lc'] = df['Species Name'].str.lower()
+    df['_common_lc'] = df['Common Name'].fillna('').str.lower()
+    return df
+
 def update_species_list(species_csv=SPECIES_CSV, meta_file=META_FILE):
     """
     Fetch the latest KEGG organism list and cache it locally as CSV.
@@ -171,10 +298,10 @@ def update_species_list(species_csv=SPECIES_CSV, meta_file=META_FILE):
         ValueError: If the response format is invalid.
     """
     print("🌐 Fetching latest KEGG species list...")
-    url = "http://rest.kegg.jp/list/organism"
+    url = "https://rest.kegg.jp/list/organism"
 
     try:
-        res = requests.get(url, timeout=10)
+        res = _SESSION.get(url, timeout=10)
         res.raise_for_status()
     except requests.RequestException as e:
         raise requests.RequestException(f"❌ Failed to fetch species list: {e}")
@@ -209,6 +336,12 @@ def update_species_list(species_csv=SPECIES_CSV, meta_file=META_FILE):
 
     try:
         df_species.to_csv(species_csv, index=False)
+        # Columnar, pre-typed cache: loads several times faster than CSV.
+        # CSV stays on disk for backward compat / hand inspection.
+        try:
+            df_species.to_parquet(_species_parquet_path(species_csv), compression="zstd")
+        except Exception as e:
+            print(f"⚠️ Could not write parquet cache ({e}). Falling back to CSV only.")
         with open(meta_file, "w") as f:
             f.write(datetime.now().strftime("%Y-%m-%d"))
         print(f"✅ Saved KEGG species to: {species_csv}")
@@ -216,7 +349,7 @@ def update_species_list(species_csv=SPECIES_CSV, meta_file=META_FILE):
     except Exception as e:
         raise OSError(f"❌ Failed to write cache files: {e}")
 
-    return df_species
+    return _with_lowercase_columns(df_species)
 
 def is_cache_stale(species_csv="species_cache.csv", meta_file="species_cache_meta.txt", interval_days=7):
     """
@@ -248,10 +381,18 @@ def is_cache_stale(species_csv="species_cache.csv", meta_file="species_cache_met
         print(f"⚠️ Error reading metadata: {e}")
         return True
 
+# Process-lifetime memo for load_species_data, keyed by its arguments.
+_species_df_cache = {}
+
 def load_species_data(species_csv="species_cache.csv", meta_file="species_cache_meta.txt", interval_days=7):
     """
     Load the species DataFrame from cache, or update it if stale.
 
+    The frame is also memoized at module scope per argument set, so
+    every pipeline call after the first in a process reuses the same
+    object instead of re-reading (or re-fetching) the species list.
+    Callers must treat the returned frame as read-only.
+
     Parameters:
         species_csv (str): Path to species CSV file.
         meta_file (str): Path to metadata file.
@@ -259,22 +400,71 @@ def load_species_data(species_csv="species_cache.csv", meta_file="species_cache_
 
     Returns:
         pd.DataFrame: Cached or freshly pulled KEGG species data.
-    
+
     Raises:
         OSError: If file cannot be read or written.
     """
+    key = (species_csv, meta_file, interval_days)
+    cached = _species_df_cache.get(key)
+    if cached is not None:
+        return cached
+
     try:
         if is_cache_stale(species_csv, meta_file, interval_days):
-            return update_species_list(species_csv, meta_file)
+            df = update_species_list(species_csv, meta_file)
         else:
             print("📁 Using cached KEGG species list.")
-            df = pd.read_csv(species_csv)
+            parquet_path = _species_parquet_path(species_csv)
+            if os.path.exists(parquet_path):
+                df = pd.read_parquet(parquet_path)
+            else:
+                df = pd.read_csv(species_csv, dtype=_SPECIES_DTYPES, engine="c")
             if df.empty:
                 raise ValueError("❌ Species CSV is empty or corrupted.")
-            return df
+            df = _with_lowercase_columns(df)
     except Exception as e:
         raise OSError(f"❌ Failed to load species data: {e}")
 
+    _species_df_cache[key] = df
+    return df
+
+def _species_lookup_tables(species_df):
+    """
+    Build lookup dicts from the KEGG species list in a single pass.
+
+    Returns:
+        tuple: (name_to_id, name_to_latin, id_lookup) where
+            name_to_id: lowercase latin/common name → KEGG species ID
+            name_to_latin: lowercase latin/common name → latin name
+            id_lookup: lowercase KEGG ID → (KEGG ID, latin name)
+
+    Scanning species_df row by row (iterrows) for every user input is
+    O(rows) per query; these dicts make each resolution a hash lookup.
+    Case-folded values come from the _*_lc columns that
+    load_species_data precomputes (added on the fly if a caller passes
+    a raw frame).
+    """
+    if '_sid_lc' not in species_df.columns:
+        species_df = _with_lowercase_columns(species_df.copy())
+
+    name_to_id, name_to_latin, id_lookup = {}, {}, {}
+
+    for sid, sid_lc, latin, name_lc, common_lc in zip(species_df['Species ID'],
+                                                      species_df['_sid_lc'],
+                                                      species_df['Species Name'],
+                                                      species_df['_name_lc'],
+                                                      species_df['_common_lc']):
+        if isinstance(sid, str):
+            id_lookup[sid_lc] = (sid, latin)
+        if isinstance(latin, str):
+            name_to_id.setdefault(name_lc, sid)
+            name_to_latin.setdefault(name_lc, latin)
+        if isinstance(common_lc, str) and common_lc:
+            name_to_id.setdefault(common_lc, sid)
+            name_to_latin.setdefault(common_lc, latin)
+
+    return name_to_id, name_to_latin, id_lookup
+
 def map_species_from_single_input(species_df, gene_df):
     """
     Prompt user for a single species name or ID, map it to KEGG ID,
@@ -287,28 +477,16 @@ def map_species_from_single_input(species_df, gene_df):
     Returns:
         tuple: (species_name, species_id, gene_list) or None if failed.
     """
-    latin_common_names = []
-    species_ids = []
-
-    for _, row in species_df.iterrows():
-        if isinstance(row['Species Name'], str):
-            latin_common_names.append(row['Species Name'].lower())
-        if isinstance(row['Common Name'], str):
-            latin_common_names.append(row['Common Name'].lower())
-        if isinstance(row['Species ID'], str):
-            species_ids.append(row['Species ID'].lower())
+    name_to_id, name_to_latin, id_lookup = _species_lookup_tables(species_df)
+    latin_common_names = list(name_to_id)
 
     while True:
         species_input = input("\n🧠 Enter your species (e.g. 'homo sapiens', 'mouse', or 'hsa'): ").strip().lower()
 
         # Direct KEGG ID match
-        if len(species_input) == 3 and species_input in species_ids:
-            for _, row in species_df.iterrows():
-                if species_input == row['Species ID'].lower():
-                    species_id = row['Species ID']
-                    matched_name = row['Species Name']
-                    print(f"\n✅ Matched KEGG ID directly: {species_id} ({matched_name})")
-                    break
+        if len(species_input) == 3 and species_input in id_lookup:
+            species_id, matched_name = id_lookup[species_input]
+            print(f"\n✅ Matched KEGG ID directly: {species_id} ({matched_name})")
             break
 
         # Fuzzy match
@@ -330,25 +508,20 @@ def map_species_from_single_input(species_df, gene_df):
             print("❌ Invalid selection.")
             continue
 
-        for _, row in species_df.iterrows():
-            if confirmed == str(row['Species Name']).lower() or confirmed == str(row['Common Name']).lower():
-                species_id = row['Species ID']
-                matched_name = row['Species Name']
-                break
+        species_id = name_to_id.get(confirmed)
+        matched_name = name_to_latin.get(confirmed)
 
         if species_id:
             print(f"\n✅ Final match: {species_id} ({matched_name})")
             break
 
     # Extract genes
-    filtered_df = gene_df[gene_df['Species ID'].str.lower() == species_id.lower()]
-    if filtered_df.empty:
+    gene_str = _species_gene_index(gene_df).get(species_id.lower())
+    if not isinstance(gene_str, str):
         print("⚠️ No genes found for this species in KO entry.")
         return None
 
-    gene_str = filtered_df.iloc[0]['Genes']
-    raw_genes = gene_str.split(' ')
-    gene_list = [g.strip().split()[-1] for g in raw_genes]
+    gene_list = gene_str.split()
 
     print(f"\n🧬 Genes for {matched_name}:")
     for g in gene_list:
@@ -377,33 +550,32 @@ def map_species_from_csv(csv_path, species_df, gene_df, output_file="species_id_
     if 'species' not in df_input.columns:
         raise KeyError("❌ CSV must have a column named 'species'")
 
-    latin_common_names = []
-    for _, row in species_df.iterrows():
-        if isinstance(row['Species Name'], str):
-            latin_common_names.append(row['Species Name'].lower())
-        if isinstance(row['Common Name'], str):
-            latin_common_names.append(row['Common Name'].lower())
+    name_to_id, name_to_latin, _ = _species_lookup_tables(species_df)
+    latin_common_names = list(name_to_id)
+
+    gene_lookup = _species_gene_index(gene_df)
 
     matched_ids, matched_names, gene_lists = [], [], []
 
-    for name in df_input['species']:
-        result = process.extractOne(name.lower(), latin_common_names, score_cutoff=85)
-        if result:
-            match, score, _ = result
-            matched_id, matched_name = None, None
-            for _, row in species_df.iterrows():
-                if str(row['Species Name']).lower() == match or str(row['Common Name']).lower() == match:
-                    matched_id = row['Species ID']
-                    matched_name = row['Species Name']
-                    break
+    # Score all inputs against all candidate names in one C-level call
+    # (parallelized across cores) instead of per-row extractOne calls.
+    queries = [str(name).lower() for name in df_input['species']]
+    scores = process.cdist(queries, latin_common_names,
+                           scorer=fuzz.WRatio, score_cutoff=85, workers=-1)
+
+    # Pick each row's winner in two whole-matrix NumPy reductions rather
+    # than one argmax call per input row.
+    best_cols = scores.argmax(axis=1)
+    best_scores = scores.max(axis=1)
+
+    for best, best_score in zip(best_cols, best_scores):
+        if best_score >= 85:
+            match = latin_common_names[best]
+            matched_id = name_to_id.get(match)
+            matched_name = name_to_latin.get(match)
             if matched_id:
-                filtered_df = gene_df[gene_df['Species ID'].str.lower() == matched_id.lower()]
-                if not filtered_df.empty:
-                    gene_str = filtered_df.iloc[0]['Genes']
-                    raw_genes = gene_str.split(' ')
-                    genes = [g.strip().split()[-1] for g in raw_genes]
-                else:
-                    genes = []
+                gene_str = gene_lookup.get(matched_id.lower())
+                genes = gene_str.split() if isinstance(gene_str, str) else []
                 matched_ids.append(matched_id)
                 matched_names.append(matched_name)
                 gene_lists.append(genes)
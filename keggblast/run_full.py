@@ -1,23 +1,69 @@
+from __future__ import annotations
+
 import os
-from keggblast.utils import (
+from keggblast.kegg_utils import (
         fetch_kegg_orthology,
         parse_gene_table,
         load_species_data,
         map_species_from_single_input,
-        fetch_gene_entry,
-        extract_sequence,
-        write_fasta_file
+        map_species_from_csv,
+        fetch_gene_entries,
     )
-from keggblast.blast_ncbi import run_ncbi_blast
-from keggblast.json_tools import parse_json_blast_to_table
+from keggblast.fasta_tools import extract_sequence, write_multi_fasta_file
+from keggblast.blast_ncbi import run_ncbi_blast_multi
+from keggblast.json_tools import blast_results_to_csv
+
+def _fetch_and_write_species_fastas(species_id, gene_list, sequence_type):
+    """
+    Fetch KEGG entries for one species and write its multi-FASTA files.
+
+    Shared by both pipelines (they previously carried pasted copies of
+    this block). Entries come down through the batched concurrent
+    fetcher; sequences are buffered and written as one multi-FASTA per
+    sequence type under fasta_output/<species_id>/.
+
+    Returns:
+        str: The species FASTA directory.
+    """
+    sp_dir = os.path.join("fasta_output", species_id)
+    os.makedirs(sp_dir, exist_ok=True)
+
+    entries = fetch_gene_entries([f"{species_id}:{gene_id}" for gene_id in gene_list])
+
+    # Resolve the sequence_type choice once, not once per gene.
+    need_aa = sequence_type in ("amino", "both")
+    need_nt = sequence_type in ("gene", "both")
+
+    amino_records, gene_records = [], []
+    for gene_id in gene_list:
+        entry = entries.get(f"{species_id}:{gene_id}")
+        if entry is None:
+            continue
+
+        if need_aa:
+            aa_seq = extract_sequence(entry, "AASEQ")
+            if aa_seq:
+                amino_records.append((f"{gene_id}_amino", aa_seq))
+
+        if need_nt:
+            nt_seq = extract_sequence(entry, "NTSEQ")
+            if nt_seq:
+                gene_records.append((f"{gene_id}_gene", nt_seq))
+
+    if amino_records:
+        write_multi_fasta_file(os.path.join(sp_dir, f"{species_id}_amino.fasta"), amino_records)
+    if gene_records:
+        write_multi_fasta_file(os.path.join(sp_dir, f"{species_id}_gene.fasta"), gene_records)
+
+    return sp_dir
 
 def run_full_pipeline_single(
-    ko_id,
-    sequence_type="both",          # "amino", "gene", or "both"
-    blast_program="blastp",
-    blast_database="nr",
-    tax_query=None                 # e.g. "txid4751[ORGN]"
-):
+    ko_id: str,
+    sequence_type: str = "both",   # "amino", "gene", or "both"
+    blast_program: str = "blastp",
+    blast_database: str = "nr",
+    tax_query: str | None = None   # e.g. "txid4751[ORGN]"
+) -> None:
     """
     Run the full pipeline for a single species:
     - KO parsing
@@ -49,25 +95,10 @@ def run_full_pipeline_single(
         return
 
     # 3. Fetch sequences and save FASTA
-    output_root = "fasta_output"
-    sp_dir = os.path.join(output_root, species_id)
-    os.makedirs(sp_dir, exist_ok=True)
+    sp_dir = _fetch_and_write_species_fastas(species_id, gene_list, sequence_type)
 
-    for gene_id in gene_list:
-        entry = fetch_gene_entry(f"{species_id}:{gene_id}")
-
-        if sequence_type in ("amino", "both"):
-            aa_seq = extract_sequence(entry, "AASEQ")
-            if aa_seq:
-                write_fasta_file(os.path.join(sp_dir, f"{gene_id}_amino.fasta"), gene_id, aa_seq)
-
-        if sequence_type in ("gene", "both"):
-            nt_seq = extract_sequence(entry, "NTSEQ")
-            if nt_seq:
-                write_fasta_file(os.path.join(sp_dir, f"{gene_id}_gene.fasta"), gene_id, nt_seq)
-
-    # 4. Run NCBI BLAST
-    run_ncbi_blast_all(
+    # 4. Run NCBI BLAST (batched: record headers become query names)
+    run_ncbi_blast_multi(
         program=blast_program,
         database=blast_database,
         tax_query=tax_query,
@@ -75,20 +106,18 @@ def run_full_pipeline_single(
         output_dir="blast_results_ncbi"
     )
 
-    # 5. Parse JSON → DataFrame
+    # 5. Parse JSON → merged CSV
     print("\n📊 Parsing BLAST results...")
-    df = parse_json_blast_to_table("blast_results_ncbi")
-    df.to_csv("single_blast_results.csv", index=False)
-    print("✅ Saved BLAST result table to single_blast_results.csv")
+    blast_results_to_csv("blast_results_ncbi", "single_blast_results.csv")
 
 def run_full_pipeline_csv(
-    csv_path,
-    ko_id,
-    sequence_type="amino",  # or "gene" or "both"
-    blast_program="blastp",
-    blast_database="nr",
-    tax_query=None
-):
+    csv_path: str,
+    ko_id: str,
+    sequence_type: str = "amino",  # or "gene" or "both"
+    blast_program: str = "blastp",
+    blast_database: str = "nr",
+    tax_query: str | None = None
+) -> None:
     """
     Run the full KO ➡️ FASTA ➡️ BLAST ➡️ table pipeline for a CSV of species.
 
@@ -119,30 +148,22 @@ def run_full_pipeline_csv(
         
     print(f"\n📦 Preparing sequences for {len(results)} matched species...")
 
-    for _, row in results.iterrows():
-        sp_name = row['species']
-        sp_id = row['KEGG Species ID']
-        genes = row['Genes'].split(' ') if row['Genes'] != 'none found' else []
-    
-        for gene_id in genes:
-            entry_text = fetch_gene_entry(f"{sp_id}:{gene_id}")
-            if sequence_type in ["amino", "both"]:
-                aa_seq = extract_sequence(entry_text, "AASEQ")
-                if aa_seq:
-                    aa_path = f"fasta_output/{sp_id}/{gene_id}_amino.fasta"
-                    os.makedirs(os.path.dirname(aa_path), exist_ok=True)
-                    write_fasta_file(aa_path, gene_id, aa_seq)
-    
-            if sequence_type in ["gene", "both"]:
-                nt_seq = extract_sequence(entry_text, "NTSEQ")
-                if nt_seq:
-                    nt_path = f"fasta_output/{sp_id}/{gene_id}_gene.fasta"
-                    os.makedirs(os.path.dirname(nt_path), exist_ok=True)
-                    write_fasta_file(nt_path, gene_id, nt_seq)
-
-    # 3. Run BLAST
+    # Pull the two consumed columns out as plain Python lists in one
+    # shot — from here on the loop never touches pandas, so there is no
+    # per-row Series construction or per-value boxing.
+    species_ids = results['KEGG Species ID'].tolist()
+    gene_strings = results['Genes'].tolist()
+
+    for sp_id, genes_raw in zip(species_ids, gene_strings):
+        genes = genes_raw.split(';') if genes_raw != 'none found' else []
+
+        if genes:
+            _fetch_and_write_species_fastas(sp_id, genes, sequence_type)
+
+    # 3. Run BLAST — batched submissions share RIDs across sequences,
+    # so the per-RID poll wait is paid once per batch, not per gene.
     print("\n🚀 Launching NCBI BLAST...")
-    run_ncbi_blast_all(
+    run_ncbi_blast_multi(
         program=blast_program,
         database=blast_database,
         tax_query=tax_query,
@@ -150,8 +171,6 @@ def run_full_pipeline_csv(
         output_dir="blast_results_ncbi"
     )
 
-    # 4. Parse JSONs
+    # 4. Parse JSONs → merged CSV
     print("\n📊 Parsing all BLAST JSONs to table...")
-    df = parse_json_blast_to_table("blast_results_ncbi")
-    df.to_csv("blast_summary_csv_mode.csv", index=False)
-    print("✅ Final BLAST table saved: blast_summary_csv_mode.csv")
+    blast_results_to_csv("blast_results_ncbi", "blast_summary_csv_mode.csv")
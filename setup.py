@@ -14,9 +14,14 @@ setup(
     packages=find_packages(),
     install_requires=[
         "requests",
+        "requests-cache",
         "pandas",
+        "pyarrow",
         "gget",
-        "rapidfuzz"
+        "rapidfuzz",
+        "biopython",
+        "orjson",
+        "lxml"
     ],
     python_requires=">=3.7"
 )